@@ -0,0 +1,163 @@
+"""
+Golden-trace regression harness for the Mario Expert agent.
+
+Records a reference run from init.state as one JSON line per action - the frame, the action, a hash of game_area and
+the key game_state fields - and replays candidate builds headlessly against it, reporting the first action where they
+diverge. Both the reference and the candidate are streamed so a divergence stops the run straight away.
+
+Example:
+    python3 golden_trace.py record -t golden.jsonl
+    python3 golden_trace.py compare -t golden.jsonl --build ../../candidate/scripts
+"""
+
+import argparse
+import collections
+import contextlib
+import hashlib
+import importlib.util
+import itertools
+import json
+import logging
+import os
+import sys
+from pathlib import Path
+
+logging.basicConfig(level=logging.INFO)
+
+STATE_FIELDS = ["lives", "score", "coins", "world", "stage", "x_position", "time"]
+
+
+def load_expert(build):
+    # the build's own mario_environment/pyboy_environment must win the import
+    sys.path.insert(0, build)
+    spec = importlib.util.spec_from_file_location("mario_expert", f"{build}/mario_expert.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.MarioExpert
+
+
+def area_hash(game_area):
+    return hashlib.blake2b(game_area.tobytes(), digest_size=8).hexdigest()
+
+
+def trace(build, max_actions):
+    """
+    Runs the build headlessly from init.state and yields one record per action it sends to the emulator,
+    followed by a final record (action None) with the state the run ended in.
+    """
+    MarioExpert = load_expert(build)
+
+    # the expert narrates every decision on stdout - keep it out of the harness output
+    devnull = open(os.devnull, "w", encoding="utf-8")
+    with contextlib.redirect_stdout(devnull):
+        expert = MarioExpert(results_path="", headless=True)
+    expert.delay_scale = 0.0
+
+    environment = expert.environment
+    run_action = environment.run_action
+    records = collections.deque()
+
+    def snapshot(action):
+        state = environment.game_state()
+        record = {
+            "frame": environment.pyboy.frame_count,
+            "action": action,
+            "area": area_hash(environment.game_area()),
+        }
+        record.update({field: state[field] for field in STATE_FIELDS})
+        return record
+
+    # actions are recorded where they reach the emulator - the expert also runs some from inside choose_action
+    def traced_run_action(action):
+        records.append(snapshot(action))
+        run_action(action)
+
+    environment.run_action = traced_run_action
+    environment.reset()
+
+    try:
+        count = 0
+        while count < max_actions and not environment.get_game_over():
+            with contextlib.redirect_stdout(devnull):
+                expert.step()
+            # hand records over as they are produced so a divergence stops the run early
+            while records and count < max_actions:
+                yield records.popleft()
+                count += 1
+
+        yield snapshot(None)
+    finally:
+        environment.pyboy.stop(save=False)
+        devnull.close()
+
+
+def read_trace(trace_path):
+    with open(trace_path, "r", encoding="utf-8") as file:
+        header = json.loads(file.readline())
+        yield header
+        for line in file:
+            yield json.loads(line)
+
+
+def record(build, trace_path, max_actions):
+    count = 0
+    with open(trace_path, "w", encoding="utf-8") as file:
+        file.write(json.dumps({"build": build, "max_actions": max_actions}) + "\n")
+        for entry in trace(build, max_actions):
+            file.write(json.dumps(entry) + "\n")
+            count += 1
+
+    logging.info(f"Recorded {count} records into {trace_path}")
+
+
+def compare(build, trace_path):
+    """
+    Returns the index of the first diverging record or None if the candidate matches the reference.
+    """
+    reference = read_trace(trace_path)
+    header = next(reference)
+    candidate = trace(build, header["max_actions"])
+
+    index = 0
+    for expected, actual in itertools.zip_longest(reference, candidate):
+        if expected != actual:
+            if expected is None or actual is None:
+                # one side ran out first - the runs ended in different places
+                logging.error(f"Divergence at record {index}: traces differ in length")
+            else:
+                logging.error(f"Divergence at record {index} (frame {expected['frame']})")
+                for key in expected:
+                    if expected[key] != actual.get(key):
+                        logging.error(f"  {key}: expected {expected[key]} got {actual.get(key)}")
+            candidate.close()
+            return index
+        index += 1
+
+    logging.info(f"No divergence across {index} records")
+    return None
+
+
+def get_args():
+    parse_args = argparse.ArgumentParser()
+
+    parse_args.add_argument("mode", type=str, choices=["record", "compare"])
+    parse_args.add_argument("-t", "--trace", type=str, required=True)
+    parse_args.add_argument("--build", type=str, default=str(Path(__file__).parent))
+    parse_args.add_argument("--max_actions", type=int, default=2000)
+
+    return parse_args.parse_args()
+
+
+def main():
+    args = get_args()
+
+    build = os.path.abspath(args.build)
+
+    if args.mode == "record":
+        record(build, args.trace, args.max_actions)
+    elif compare(build, args.trace) is not None:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,15 +6,435 @@ Your goal is to implement the functions and methods required to enable choose_ac
 Original Mario Manual: https://www.thegameisafootarcade.com/wp-content/uploads/2017/04/Super-Mario-Land-Game-Manual.pdf
 """
 
+import atexit
+import collections
+import http.server
 import json
 import logging
+import multiprocessing
+import os
 import random
+import shutil
+import signal
+import socketserver
+import stat
+import subprocess
+import sys
+import threading
 import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 
 import cv2
+import numpy as np
 from mario_environment import MarioEnvironment
 from pyboy.utils import WindowEvent
 
+try:
+    # optional - bundles the ffmpeg that joins recorded video segments without re-encoding them
+    import imageio_ffmpeg
+except ImportError:
+    imageio_ffmpeg = None
+
+# Declarative rule table - only mario_expert.py is submitted so the default lives here, set MARIO_RULES to a JSON file
+# with the same layout to load a different one.
+#
+# checks: tiles to look for around Mario, offsets are [dx, dy] in Mario's local coordinates
+#         +Y
+#          ^
+#          |
+#        mario ---------> +X
+#   "any" matches if the tile is at any of the offsets, "all" only if it is at every one of them - offsets off the
+#   grid never match.
+# macros: action sequences queued by choose_action, named after the rule that queues them
+RULES: dict[str, dict] = {
+    "checks": {
+        "enemy_15_front": {"match": "any", "tile": 15, "offsets": [[2, 0], [2, 1]]},
+        "block_12_above": {"match": "any", "tile": 12, "offsets": [[0, 3], [1, 3]]},
+        "block_13_above": {"match": "any", "tile": 13, "offsets": [[0, 3], [1, 3]]},
+        "block_10_above": {"match": "any", "tile": 10, "offsets": [[0, 3], [1, 3]]},
+        "enemy_15_up_close": {"match": "any", "tile": 15, "offsets": [[2, 2], [2, 3], [3, 2], [3, 3]]},
+        "enemy_15_far": {"match": "any", "tile": 15, "offsets": [[5, 0]]},
+        "enemy_16_far": {"match": "any", "tile": 16, "offsets": [[5, 0]]},
+        "enemy_18_front": {"match": "any", "tile": 18, "offsets": [[2, 0], [2, 1], [3, 0], [3, 1]]},
+        "enemy_18_above": {"match": "any", "tile": 18, "offsets": [[3, 2], [3, 3]]},
+        "enemy_15_below": {"match": "any", "tile": 15, "offsets": [[2, -1], [2, -2], [3, -1], [3, -2]]},
+        "enemy_15_ahead": {
+            "match": "any",
+            "tile": 15,
+            "offsets": [[3, 0], [3, 1], [4, 0], [4, 1], [4, 2], [4, 3], [4, 4], [5, 3], [5, 4], [6, 3], [6, 4]],
+        },
+        "gap_3_to_5": {"match": "all", "tile": 0, "offsets": [[3, -1], [4, -1], [5, -1]]},
+        "ledge_6": {"match": "all", "tile": 10, "offsets": [[6, 0], [6, 1]]},
+        "gap_4_to_6": {"match": "all", "tile": 0, "offsets": [[6, -1], [4, -1], [5, -1]]},
+        "ledge_7": {"match": "all", "tile": 10, "offsets": [[7, 0], [7, 1]]},
+        "gap_1_to_3": {"match": "any", "tile": 0, "offsets": [[1, -1], [2, -1], [3, -1]]},
+        "column_under": {"match": "all", "tile": 10, "offsets": [[0, -1], [0, -2], [0, -3], [0, -4]]},
+        "drop_ahead": {"match": "all", "tile": 0, "offsets": [[2, -1], [2, -2], [2, -3], [2, -4]]},
+        "block_13_top": {"match": "any", "tile": 13, "offsets": [[0, 4], [1, 4]]},
+        "tile_6_above": {"match": "any", "tile": 6, "offsets": [[0, 5], [0, 6], [1, 5], [1, 6]]},
+        "pipe_14_front": {"match": "any", "tile": 14, "offsets": [[3, 0], [2, 0]]},
+        "block_10_front": {"match": "any", "tile": 10, "offsets": [[3, 0], [2, 0], [1, 0]]},
+        "block_12_front": {"match": "any", "tile": 12, "offsets": [[3, 0], [2, 0], [1, 0], [3, 1], [2, 1], [1, 1]]},
+        "gap_3": {"match": "any", "tile": 0, "offsets": [[3, -1]]},
+        "block_10_high": {"match": "any", "tile": 10, "offsets": [[3, 2], [3, 3]]},
+        "gap_1_to_6": {"match": "any", "tile": 0, "offsets": [[1, -1], [2, -1], [3, -1], [4, -1], [5, -1], [6, -1]]},
+        "ledge_2": {"match": "any", "tile": 10, "offsets": [[2, -1]]},
+        "ground": {"match": "any", "tile": 10, "offsets": [[0, -1]]},
+    },
+    "macros": {
+        "enemy_15_blocked": [1, 1],
+        "enemy_15_wait_jump": [0, 4],
+        "enemy_18_above_back": [1, 1, 2],
+        "block_13_above_jump": [1, 0, 4],
+        "pipe_14_jump": [2, 2, 4, 2, 2],
+        "block_10_jump": [2, 4, 2, 2],
+        "block_12_jump": [2, 4, 2, 2],
+        "one_two_jump": [2, 4],
+    },
+}
+
+
+class AgentMetrics:
+    """
+    Opt-in cumulative timings and counters for long-running agents.
+
+    Everything is a no-op unless enabled, so the instrumentation can stay in the hot paths. Set MARIO_METRICS=1 to
+    enable it for a run.
+
+    Args:
+        enabled (bool): Whether to collect anything. Defaults to False.
+    """
+
+    def __init__(self, enabled: bool = False) -> None:
+        self.enabled = enabled
+        self.counters: dict[str, int] = {}
+        self.timers: dict[str, list] = {}
+        self.started = time.time()
+
+    def count(self, name: str, amount: int = 1) -> None:
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record(self, name: str, start: float) -> None:
+        # start is a time.perf_counter() value taken before the timed section
+        if self.enabled:
+            timer = self.timers.setdefault(name, [0, 0.0])
+            timer[0] += 1
+            timer[1] += time.perf_counter() - start
+
+    def snapshot(self) -> dict[str, any]:
+        # copied item by item as the metrics endpoint reads this from another thread
+        return {
+            "uptime_s": time.time() - self.started,
+            "counters": dict(list(self.counters.items())),
+            "timers": {
+                name: {"calls": calls, "total_s": total, "mean_us": total / calls * 1e6}
+                for name, (calls, total) in list(self.timers.items())
+            },
+        }
+
+
+class StackSampler:
+    """
+    Sampling profiler for a window of agent steps.
+
+    A CPU-time interval timer (ITIMER_PROF) interrupts the main thread and the SIGPROF handler records the stack it
+    interrupted, so the emulator tick and OpenCV calls are sampled alongside the agent's own Python code. Python only
+    runs the handler once a native call returns, so each sample is weighted by the CPU time since the previous one.
+    Samples are written in the collapsed "frame;frame;frame weight" format read by flamegraph.pl and speedscope, with
+    weights in microseconds of CPU time.
+
+    Needs signal.setitimer (not available on Windows) and must be started from the main thread.
+
+    Args:
+        interval (float): Seconds of CPU time between samples. Defaults to 0.005.
+    """
+
+    def __init__(self, interval: float = 0.005) -> None:
+        self.interval = interval
+        self.stacks: collections.Counter = collections.Counter()
+        self.running = False
+
+        self._last = 0.0
+        self._previous_handler = None
+
+    def start(self) -> None:
+        self._previous_handler = signal.signal(signal.SIGPROF, self._sample)
+        self._last = time.process_time()
+        self.running = True
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self) -> None:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        # None means the previous handler was not installed from Python
+        signal.signal(signal.SIGPROF, self._previous_handler or signal.SIG_DFL)
+        self.running = False
+
+    def _sample(self, signum, frame) -> None:
+        now = time.process_time()
+        weight = round((now - self._last) * 1e6)
+        self._last = now
+
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        if stack and weight > 0:
+            self.stacks[";".join(reversed(stack))] += weight
+
+    def dump(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as file:
+            for stack, samples in self.stacks.most_common():
+                file.write(f"{stack} {samples}\n")
+
+
+def serve_metrics(address: str, summary) -> socketserver.BaseServer:
+    """
+    Serves summary() as JSON from a background thread.
+
+    address is either "host:port" for a local HTTP endpoint or a filesystem path for a Unix socket
+    (query it with: curl --unix-socket <path> http://localhost/).
+    """
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(summary()).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    if ":" in address:
+        host, port = address.rsplit(":", 1)
+        server = http.server.ThreadingHTTPServer((host, int(port)), MetricsHandler)
+    else:
+
+        class UnixMetricsServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        remove_socket(address)
+        server = UnixMetricsServer(address, MetricsHandler)
+        # covers runs that never reach stop_metrics
+        atexit.register(remove_socket, address)
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Serving metrics on {address}")
+    return server
+
+
+def stop_metrics(server: socketserver.BaseServer) -> None:
+    server.shutdown()
+    server.server_close()
+    if isinstance(server.server_address, str):
+        remove_socket(server.server_address)
+
+
+def remove_socket(path: str) -> None:
+    # only ever unlink a stale socket - never whatever other file the address happens to name
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        os.remove(path)
+
+
+def encode_video_segment(path: str, frames: np.ndarray, fps: float, size: tuple[int, int]) -> str:
+    # runs in a worker process - upscales the raw 160x144 frames and encodes them as one mp4v segment
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, size)
+    for frame in frames:
+        writer.write(cv2.resize(frame, size))
+    writer.release()
+    return path
+
+
+def encode_palette_segment(path: str, frames: np.ndarray) -> str:
+    # runs in a worker process - the Game Boy only shows a handful of colours so store an index per pixel
+    packed = (
+        frames[..., 0].astype(np.uint32) << 16 | frames[..., 1].astype(np.uint32) << 8 | frames[..., 2]
+    )
+    colours, indices = np.unique(packed, return_inverse=True)
+    palette = np.stack([colours >> 16, colours >> 8, colours], axis=-1).astype(np.uint8)
+    np.savez_compressed(path, palette=palette, frames=indices.reshape(packed.shape).astype(np.uint8))
+    return path
+
+
+def find_ffmpeg() -> str:
+    """
+    Returns the path of an ffmpeg executable or None - imageio-ffmpeg's bundled binary is preferred.
+    """
+    if imageio_ffmpeg is not None:
+        try:
+            return imageio_ffmpeg.get_ffmpeg_exe()
+        except RuntimeError:
+            # installed without a binary for this platform
+            pass
+    return shutil.which("ffmpeg")
+
+
+class SegmentedRecorder:
+    """
+    Drop-in replacement for cv2.VideoWriter that encodes the episode in parallel.
+
+    Raw frames are buffered into fixed-length segments, each segment is encoded in a worker process and the segments
+    are concatenated when the recorder is released. Only every stride-th frame is kept. mp4 segments are joined by
+    stream copy through ffmpeg (imageio-ffmpeg's bundled binary, else one on the PATH) - without it the segments and
+    their concat list are kept next to the video rather than decoded and encoded a second time.
+
+    Args:
+        video_name (str): Path of the final mp4 - the palette archive is written next to it as .npz.
+        fps (float): Frame rate of the recorded frames.
+        video_format (str): "mp4" for an mp4v video or "palette" for a palette-indexed frame archive.
+        segment_frames (int): Frames per segment - must be at least 1.
+        stride (int): Keep every Nth frame. Defaults to 1.
+        size (tuple[int, int]): Output (width, height) of the mp4. Defaults to (300, 240).
+        workers (int, optional): Number of encoding processes. Defaults to the number of CPUs.
+        metrics (AgentMetrics, optional): Counts the frames that are kept for encoding.
+    """
+
+    def __init__(
+        self,
+        video_name: str,
+        fps: float,
+        video_format: str,
+        segment_frames: int,
+        stride: int = 1,
+        size: tuple[int, int] = (300, 240),
+        workers: int = None,
+        metrics: AgentMetrics = None,
+    ) -> None:
+        if video_format not in ("mp4", "palette"):
+            raise ValueError(f"Unknown video format: {video_format}")
+        if segment_frames < 1:
+            raise ValueError(f"Segments need at least one frame, got {segment_frames}")
+
+        self.base_name = os.path.splitext(video_name)[0]
+        self.video_format = video_format
+        self.output_name = video_name if video_format == "mp4" else f"{self.base_name}.npz"
+        self.fps = fps / stride
+        self.segment_frames = segment_frames
+        self.stride = stride
+        self.size = size
+
+        self.metrics = metrics if metrics is not None else AgentMetrics()
+        # forking would copy the SDL window and the metrics server threads into every worker
+        self.pool = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("forkserver")
+        )
+        self.segments = []
+        self.frames = []
+        self.frame_count = 0
+
+    def write(self, frame: np.ndarray) -> None:
+        if self.frame_count % self.stride == 0:
+            self.frames.append(frame)
+            self.metrics.count("frames_encoded")
+            if len(self.frames) == self.segment_frames:
+                self._submit()
+        self.frame_count += 1
+
+    def _submit(self) -> None:
+        if not self.frames:
+            return
+
+        frames = np.stack(self.frames)
+        self.frames = []
+
+        part = f"{self.base_name}.part{len(self.segments):04d}"
+        if self.video_format == "mp4":
+            future = self.pool.submit(encode_video_segment, f"{part}.mp4", frames, self.fps, self.size)
+        else:
+            future = self.pool.submit(encode_palette_segment, f"{part}.npz", frames)
+        self.segments.append(future)
+
+    def release(self) -> None:
+        self._submit()
+        parts = [segment.result() for segment in self.segments]
+        self.pool.shutdown()
+
+        if not parts:
+            logging.warning("No frames were recorded")
+            return
+
+        if self.video_format == "mp4":
+            if not self._concatenate_video(parts):
+                return
+        else:
+            self._concatenate_palette(parts)
+
+        for part in parts:
+            os.remove(part)
+
+    def _concatenate_video(self, parts: list[str]) -> bool:
+        list_name = f"{self.base_name}.parts.txt"
+        with open(list_name, "w", encoding="utf-8") as file:
+            for part in parts:
+                file.write(f"file '{os.path.abspath(part)}'\n")
+
+        ffmpeg = find_ffmpeg()
+        if ffmpeg is None:
+            logging.warning(
+                f"ffmpeg not found - kept the video segments, join them with: "
+                f"ffmpeg -f concat -safe 0 -i {list_name} -c copy {self.output_name}"
+            )
+            return False
+
+        # stream copy - no re-encoding
+        subprocess.run(
+            [
+                ffmpeg, "-y", "-loglevel", "error",
+                "-f", "concat", "-safe", "0", "-i", list_name,
+                "-c", "copy", self.output_name,
+            ],
+            check=True,
+        )
+        os.remove(list_name)
+        return True
+
+    def _concatenate_palette(self, parts: list[str]) -> None:
+        # segments each carry their own palette - remap them onto the union of all of them
+        archives = [np.load(part) for part in parts]
+        palette = np.unique(np.concatenate([archive["palette"] for archive in archives]), axis=0)
+
+        frames = []
+        for archive in archives:
+            matches = (archive["palette"][:, None, :] == palette[None, :, :]).all(axis=-1)
+            remap = np.argmax(matches, axis=1).astype(np.uint8)
+            frames.append(remap[archive["frames"]])
+            archive.close()
+
+        np.savez_compressed(self.output_name, palette=palette, frames=np.concatenate(frames))
+
+
+class EpisodeRecorder:
+    """
+    The object play() writes its frames to.
+
+    Wraps the video writer so encoded frames are counted, and wraps the run up when play() releases it - by then
+    results.json has been written, so this is where the metrics summary is folded in.
+
+    Args:
+        writer: The cv2.VideoWriter or SegmentedRecorder that encodes the frames.
+        expert (MarioExpert): The expert whose run is being recorded.
+    """
+
+    def __init__(self, writer, expert) -> None:
+        self.writer = writer
+        self.expert = expert
+        # the segmented recorder counts the frames it keeps itself
+        self.counts_frames = not isinstance(writer, SegmentedRecorder)
+
+    def write(self, frame: np.ndarray) -> None:
+        self.writer.write(frame)
+        if self.counts_frames:
+            self.expert.metrics.count("frames_encoded")
+
+    def release(self) -> None:
+        self.writer.release()
+        self.expert.finish_run()
+
 
 class MarioController(MarioEnvironment):
     """
@@ -34,6 +454,9 @@ class MarioController(MarioEnvironment):
         emulation_speed: int = 0,
         headless: bool = False,
     ) -> None:
+        # created first as the base class resets the game during construction
+        self.metrics = AgentMetrics(enabled=os.environ.get("MARIO_METRICS", "0") == "1")
+
         super().__init__(
             act_freq=act_freq,
             emulation_speed=emulation_speed,
@@ -64,6 +487,11 @@ class MarioController(MarioEnvironment):
 
         self.valid_actions = valid_actions
         self.release_button = release_button
+        # press/release pairs resolved once rather than looked up on every press
+        self.action_events = tuple(zip(valid_actions, release_button))
+
+        # grab_frame returns the raw 160x144 screen when the recorder does its own scaling
+        self.raw_frames = False
 
     def run_action(self, action: int) -> None:
         """
@@ -78,13 +506,388 @@ class MarioController(MarioEnvironment):
         # print("In func run_action")
         # print("the pass in action is: " + str(action))
 
-        self.pyboy.send_input(self.valid_actions[action])
+        press, release = self.action_events[action]
+        self.pyboy.send_input(press)
         # print("run action: " + str(self.valid_actions[action]))
+        start = time.perf_counter()
 
         for _ in range(self.act_freq):
             self.pyboy.tick()
 
-        self.pyboy.send_input(self.release_button[action])
+        self.pyboy.send_input(release)
+
+        self.metrics.count("actions")
+        self.metrics.count("ticks", self.act_freq)
+        self.metrics.record("run_action", start)
+
+    # Timed wrappers around the PyboyEnvironment calls - the base classes must not be modified
+    def grab_frame(self, height: int = 240, width: int = 300) -> np.ndarray:
+        start = time.perf_counter()
+        if self.raw_frames:
+            frame = cv2.cvtColor(np.array(self.screen.ndarray), cv2.COLOR_RGB2BGR)
+        else:
+            frame = super().grab_frame(height, width)
+        self.metrics.record("grab_frame", start)
+        return frame
+
+    def game_area(self) -> np.ndarray:
+        start = time.perf_counter()
+        game_area = super().game_area()
+        self.metrics.record("game_area", start)
+        return game_area
+
+    def reset(self) -> np.ndarray:
+        start = time.perf_counter()
+        super().reset()
+        self.metrics.count("resets")
+        self.metrics.record("reset", start)
+
+
+class MarioPerception:
+    """
+    Fast-path perception for the Mario Expert agent.
+
+    Answers the queries most decisions need - Mario's position, whether he is airborne and the tiles around him -
+    straight from emulator memory, reading only the OAM sprite table once per frame and the individual tilemap
+    cells a query asks for. The full game_area is only rebuilt when a rule needs the whole grid. Positions use the
+    game_area grid (20x16 tiles below the status bar) so answers are interchangeable with the rule helpers in
+    MarioExpert.
+
+    The cost of every query is accumulated in timings - see report().
+
+    Args:
+        environment (MarioController): The environment whose emulator memory is read.
+    """
+
+    GRID_WIDTH = 20
+    GRID_HEIGHT = 16
+    GRID_TOP = 2  # game_area crops the two status bar rows
+
+    def __init__(self, environment: MarioController) -> None:
+        self.environment = environment
+        self.pyboy = environment.pyboy
+        self.memory = self.pyboy.memory
+        self.mapping = np.asarray(self.pyboy.game_wrapper.mapping_compressed).tolist()
+
+        # Cross check every fast answer against the full game_area - slow, for debugging only
+        self.verify = False
+
+        self.timings: dict[str, list] = {}
+
+        self._frame = -1
+        self._tilemap_base = 0x9800
+        self._signed_tiles = False
+        self._scroll_x = 0
+        self._scroll_y = 0
+        self._sprites: list[tuple[int, int, int]] = []
+
+    def _refresh(self) -> None:
+        # OAM and the LCD registers only change when the emulator ticks - read them once per frame
+        frame = self.pyboy.frame_count
+        if frame == self._frame:
+            return
+        self._frame = frame
+
+        memory = self.memory
+
+        lcdc = memory[0xFF40]
+        self._tilemap_base = 0x9C00 if lcdc & 0x08 else 0x9800
+        self._signed_tiles = not lcdc & 0x10
+
+        # Super Mario Land only changes the scroll at the status bar, so the registers left at the end of the frame
+        # hold the playfield scroll of every grid row - saves building tilemap_position_list each frame
+        self._scroll_x = memory[0xFF43] // 8
+        self._scroll_y = memory[0xFF42] // 8
+
+        sprites = []
+        oam = memory[0xFE00:0xFEA0]
+        for i in range(0, 160, 4):
+            sprite_y = oam[i] - 16
+            sprite_x = oam[i + 1] - 8
+            row = sprite_y // 8 - self.GRID_TOP
+            col = sprite_x // 8
+            if (
+                -8 < sprite_x < 160 and -16 < sprite_y < 144
+                and 0 <= col < self.GRID_WIDTH and 0 <= row < self.GRID_HEIGHT
+            ):
+                sprites.append((row, col, self.mapping[oam[i + 2]]))
+        self._sprites = sprites
+
+    def _record(self, name: str, start: float) -> None:
+        timing = self.timings.setdefault(name, [0, 0.0])
+        timing[0] += 1
+        timing[1] += time.perf_counter() - start
+
+    def _tile(self, row: int, col: int) -> int:
+        # sprites are drawn over the background - later OAM entries win as they do in game_area
+        for sprite_row, sprite_col, tile in reversed(self._sprites):
+            if sprite_row == row and sprite_col == col:
+                return tile
+
+        map_row = (row + self.GRID_TOP + self._scroll_y) % 32
+        map_col = (col + self._scroll_x) % 32
+        tile = self.memory[self._tilemap_base + map_row * 32 + map_col]
+        if self._signed_tiles:
+            # signed tile data lives at 0x8800 - shift into the 256-383 range used by the mapping
+            tile = 256 + ((tile ^ 0x80) - 128)
+        return self.mapping[tile]
+
+    def tiles(self, rows, cols) -> list[int]:
+        """
+        Returns the game_area values at the given grid rows and columns (which must be inside the grid).
+        """
+        start = time.perf_counter()
+        self._refresh()
+        tiles = [self._tile(row, col) for row, col in zip(rows, cols)]
+        self._record("tiles", start)
+        return tiles
+
+    def mario_position(self) -> list[int]:
+        """
+        Returns Mario's position in the same form as MarioExpert.get_mario_position - [0, 0] if he is not on screen.
+        """
+        start = time.perf_counter()
+        self._refresh()
+
+        # the top-left grid cell showing Mario - another sprite may cover part of him so check what the cell reads
+        first = None
+        for row, col, tile in self._sprites:
+            if tile == 1 and (first is None or (row, col) < first) and self._tile(row, col) == 1:
+                first = (row, col)
+        position = [0, 0] if first is None else [first[1], first[0] + 1]
+        self._record("mario_position", start)
+
+        if self.verify:
+            cells = np.argwhere(self.game_area() == 1)
+            full = [int(cells[0][1]), int(cells[0][0]) + 1] if len(cells) else [0, 0]
+            if full != position:
+                logging.warning(f"mario_position mismatch: fast {position} full {full}")
+
+        return position
+
+    def is_airborne(self, mario_position: list[int]) -> bool:
+        """
+        Returns True if both tiles under Mario's feet are empty.
+        """
+        start = time.perf_counter()
+        row = mario_position[1] + 1
+        col = mario_position[0]
+        if not (0 <= row < self.GRID_HEIGHT and 0 <= col and col + 1 < self.GRID_WIDTH):
+            airborne = False
+        else:
+            self._refresh()
+            airborne = self._tile(row, col) == 0 and self._tile(row, col + 1) == 0
+        self._record("is_airborne", start)
+
+        if self.verify and airborne != self._is_airborne_full(row, col):
+            logging.warning(f"is_airborne mismatch at {mario_position}: fast {airborne}")
+
+        return airborne
+
+    def _is_airborne_full(self, row: int, col: int) -> bool:
+        if not (0 <= row < self.GRID_HEIGHT and 0 <= col and col + 1 < self.GRID_WIDTH):
+            return False
+        return bool((self.game_area()[row, col:col + 2] == 0).all())
+
+    def column_void(self, mario_position: list[int], column: int) -> bool:
+        """
+        Returns True if the grid column `column` tiles in front of Mario is empty from his feet to the bottom of the screen.
+        """
+        start = time.perf_counter()
+        col = mario_position[0] + column
+        if not 0 <= col < self.GRID_WIDTH:
+            void = False
+        else:
+            self._refresh()
+            void = all(self._tile(row, col) == 0 for row in range(mario_position[1] + 1, self.GRID_HEIGHT))
+        self._record("column_void", start)
+
+        if self.verify and 0 <= col < self.GRID_WIDTH:
+            full = bool((self.game_area()[max(mario_position[1] + 1, 0):, col] == 0).all())
+            if full != void:
+                logging.warning(f"column_void mismatch at {mario_position} column {column}: fast {void}")
+
+        return void
+
+    def game_area(self) -> np.ndarray:
+        """
+        Slow path - rebuilds the full grid through the PyBoy game wrapper.
+        """
+        start = time.perf_counter()
+        game_area = self.environment.game_area()
+        self._record("game_area", start)
+        return game_area
+
+    def report(self) -> dict[str, dict[str, float]]:
+        return {
+            name: {"calls": calls, "total_s": total, "mean_us": total / calls * 1e6}
+            for name, (calls, total) in list(self.timings.items())
+        }
+
+
+class RuleTable:
+    """
+    The expert's position checks stored as contiguous NumPy arrays - one row per offset holding the offset and the
+    tile, grouped by check.
+
+    evaluate() answers every check for a grid and Mario position at once into preallocated buffers - read the answers
+    back with hit(). Every operand is preallocated with a single index dtype so NumPy needs no casting buffers or
+    temporary scalars: once warmed up, evaluating the rules and popping the ActionQueue allocate nothing. The rest of
+    a decision still does - building game_area, the small lists MarioPerception returns and the printed narration.
+
+    Args:
+        rules (dict): A rule table in the layout of RULES.
+    """
+
+    def __init__(self, rules: dict) -> None:
+        checks = rules["checks"]
+
+        self.names = list(checks.keys())
+        self.ids = {name: check_id for check_id, name in enumerate(self.names)}
+
+        lengths = np.array([len(check["offsets"]) for check in checks.values()], dtype=np.intp)
+        rule_id = np.repeat(np.arange(len(self.names)), lengths)
+        offsets = np.array([offset for check in checks.values() for offset in check["offsets"]], dtype=np.intp)
+        self.dx = np.ascontiguousarray(offsets[:, 0])
+        self.dy = np.ascontiguousarray(offsets[:, 1])
+        self.tile = np.array([check["tile"] for check in checks.values()], dtype=np.int64)[rule_id]
+        # matched offsets a check needs - one for "any", every one of them for "all"
+        self.required = np.array(
+            [length if check["match"] == "all" else 1 for length, check in zip(lengths, checks.values())],
+            dtype=np.intp,
+        )
+        # each check's offsets as a slice of the running match count below
+        self.ends = np.cumsum(lengths)
+        self.starts = self.ends - lengths
+
+        self.macros = {name: tuple(macro) for name, macro in rules["macros"].items()}
+
+        size = len(self.dx)
+        self._x = np.zeros((), dtype=np.intp)
+        self._y = np.zeros((), dtype=np.intp)
+        self._zero = np.zeros((), dtype=np.intp)
+        self._height = np.full((), MarioPerception.GRID_HEIGHT, dtype=np.intp)
+        self._width = np.full((), MarioPerception.GRID_WIDTH, dtype=np.intp)
+        self._rows = np.empty(size, dtype=np.intp)
+        self._cols = np.empty(size, dtype=np.intp)
+        self._flat = np.empty(size, dtype=np.intp)
+        self._inside = np.empty(size, dtype=bool)
+        self._bound = np.empty(size, dtype=bool)
+        self._matches = np.empty(size, dtype=bool)
+        self._counts = np.empty(size, dtype=np.intp)
+        # running count of matches with a leading zero - a check matched ends - starts of its offsets
+        self._running = np.zeros(size + 1, dtype=np.intp)
+        self._running_tail = self._running[1:]
+        self._before = np.empty(len(self.names), dtype=np.intp)
+        self._matched = np.empty(len(self.names), dtype=np.intp)
+        self.hits = np.zeros(len(self.names), dtype=bool)
+
+        # sized for the grid dtype on the first evaluation
+        self._grid = None
+        self._grid_flat = None
+        self._values = None
+        self._tile = None
+
+    @classmethod
+    def load(cls, path: str) -> "RuleTable":
+        with open(path, "r", encoding="utf-8") as file:
+            return cls(json.load(file))
+
+    def _allocate(self, dtype: np.dtype) -> None:
+        height = MarioPerception.GRID_HEIGHT
+        width = MarioPerception.GRID_WIDTH
+        # take() on the 2D grid would ravel it into a new view every call - copy into a buffer with a fixed flat view
+        self._grid = np.empty((height, width), dtype=dtype)
+        self._grid_flat = self._grid.reshape(-1)
+        self._values = np.empty(len(self.dx), dtype=dtype)
+        self._tile = self.tile.astype(dtype)
+
+    def evaluate(self, game_area: np.ndarray, mario_position: list[int]) -> None:
+        if self._grid is None or self._grid.dtype != game_area.dtype:
+            self._allocate(game_area.dtype)
+        np.copyto(self._grid, game_area)
+
+        self._x[()] = mario_position[0]
+        self._y[()] = mario_position[1]
+
+        # local [dx, dy] to grid [row, column] - +Y is up the screen
+        np.subtract(self._y, self.dy, out=self._rows)
+        np.add(self._x, self.dx, out=self._cols)
+
+        np.greater_equal(self._rows, self._zero, out=self._inside)
+        np.less(self._rows, self._height, out=self._bound)
+        np.logical_and(self._inside, self._bound, out=self._inside)
+        np.greater_equal(self._cols, self._zero, out=self._bound)
+        np.logical_and(self._inside, self._bound, out=self._inside)
+        np.less(self._cols, self._width, out=self._bound)
+        np.logical_and(self._inside, self._bound, out=self._inside)
+
+        # offsets off the grid read a clipped cell but are masked out below
+        np.multiply(self._rows, self._width, out=self._flat)
+        np.add(self._flat, self._cols, out=self._flat)
+        self._grid_flat.take(self._flat, out=self._values, mode="clip")
+
+        np.equal(self._values, self._tile, out=self._matches)
+        np.logical_and(self._matches, self._inside, out=self._matches)
+
+        # matches per check from the running count - reductions over groups allocate their iterators
+        np.copyto(self._counts, self._matches)
+        np.add.accumulate(self._counts, out=self._running_tail)
+        self._running.take(self.ends, out=self._matched, mode="clip")
+        self._running.take(self.starts, out=self._before, mode="clip")
+        np.subtract(self._matched, self._before, out=self._matched)
+        np.greater_equal(self._matched, self.required, out=self.hits)
+
+    def hit(self, name: str) -> bool:
+        return self.hits[self.ids[name]]
+
+
+class ActionQueue:
+    """
+    Fixed-capacity ring buffer of queued actions.
+
+    Loading a macro replaces the queued actions but - like reassigning the old action_queue list did - keeps the read
+    position, so a macro loaded mid-way through another continues from the same index.
+
+    Args:
+        capacity (int): Longest macro the queue can hold. Defaults to 16.
+    """
+
+    __slots__ = ("_buffer", "_capacity", "_start", "_length", "_index")
+
+    def __init__(self, capacity: int = 16) -> None:
+        self._buffer = array("b", bytes(capacity))
+        self._capacity = capacity
+        self._start = 0
+        self._length = 0
+        self._index = 0
+
+    def __len__(self) -> int:
+        return self._length
+
+    def load(self, actions) -> None:
+        if len(actions) > self._capacity:
+            raise ValueError(f"Macro of {len(actions)} actions exceeds the queue capacity of {self._capacity}")
+
+        # a counter rather than range() - its iterator would be the only allocation of a decision's rules and queue
+        offset = 0
+        while offset < len(actions):
+            self._buffer[(self._start + offset) % self._capacity] = actions[offset]
+            offset += 1
+        self._length = len(actions)
+
+    def pop(self) -> int:
+        if self._index >= self._length:
+            raise IndexError("action queue index out of range")
+
+        action = self._buffer[(self._start + self._index) % self._capacity]
+        if self._index == self._length - 1:
+            self._start = (self._start + self._length) % self._capacity
+            self._length = 0
+            self._index = 0
+        else:
+            self._index += 1
+        return action
 
 
 class MarioExpert:
@@ -104,123 +907,176 @@ class MarioExpert:
         self.results_path = results_path
 
         self.environment = MarioController(headless=headless)
+        self.perception = MarioPerception(self.environment)
 
         self.video = None
 
-        self.action_queue = []
-        self.action_queue_index = 0
+        # Loaded once at startup - choose_action only reads the table
+        rules_path = os.environ.get("MARIO_RULES")
+        self.rules = RuleTable.load(rules_path) if rules_path else RuleTable(RULES)
+
+        self.action_queue = ActionQueue()
         self.air_timeout = 0
-        self.skip_count = 0
 
-    def choose_action(self):
-        # print("In func choose_action")
-        state = self.environment.game_state()
-        frame = self.environment.grab_frame()
-        game_area = self.environment.game_area()
-        print("===============================================")
-        print(game_area)
-        print("----------------------------------------------")
-        print(state)
-        print("===============================================")
+        # Tunables - exposed so scripts/sweep.py can search over them
+        self.air_timeout_limit = 6
+        self.void_jump_limit = 50
+        self.action_macros = dict(self.rules.macros)
+        self.delay_scale = 1.0
+        # dump the full grid on every decision that reaches the grid rules
+        self.debug = False
 
+        # Instrumentation - opt-in through environment variables as the __init__ parameters are fixed
+        #   MARIO_METRICS=1                  collect timings and counters, summarised into results.json
+        #   MARIO_METRICS_ADDRESS=host:port  serve them live over HTTP (or a path for a Unix socket)
+        #   MARIO_PROFILE_STEPS=start:stop   sample stacks for that window of steps into profile.folded
+        self.metrics = self.environment.metrics
+        self.step_count = 0
 
-        mario_position = self.get_mario_position(game_area)
+        self.metrics_server = None
+        address = os.environ.get("MARIO_METRICS_ADDRESS")
+        if self.metrics.enabled and address:
+            self.metrics_server = serve_metrics(address, self.metrics_summary)
+
+        self.profiler = None
+        self.profile_window = None
+        self.profile_path = os.environ.get("MARIO_PROFILE_PATH", f"{results_path}/profile.folded")
+        profile_steps = os.environ.get("MARIO_PROFILE_STEPS")
+        if profile_steps and not hasattr(signal, "setitimer"):
+            logging.warning("MARIO_PROFILE_STEPS needs signal.setitimer, which this platform lacks - not profiling")
+        elif profile_steps:
+            start, stop = profile_steps.split(":")
+            self.profile_window = (int(start), int(stop))
+            self.profiler = StackSampler()
+
+        # Recording - the default is the original single mp4v writer
+        #   MARIO_VIDEO_FORMAT=mp4|palette   mp4 video or a palette-indexed .npz frame archive
+        #   MARIO_VIDEO_SEGMENT=<frames>     encode segments of this many frames in worker processes (default 300)
+        #   MARIO_VIDEO_STRIDE=<n>           record every nth frame only
+        #   MARIO_VIDEO_WORKERS=<n>          number of encoding processes
+        self.video_format = os.environ.get("MARIO_VIDEO_FORMAT", "mp4")
+        self.video_segment = int(os.environ.get("MARIO_VIDEO_SEGMENT", "300"))
+        self.video_stride = int(os.environ.get("MARIO_VIDEO_STRIDE", "1"))
+        self.video_workers = int(os.environ.get("MARIO_VIDEO_WORKERS", str(os.cpu_count())))
+        self.segmented_video = (
+            self.video_format != "mp4"
+            or self.video_stride != 1
+            or "MARIO_VIDEO_SEGMENT" in os.environ
+        )
+        self.environment.raw_frames = self.segmented_video
+
+    def choose_action(self):
+        # print("In func choose_action")
+        # Position and airborne state come straight from VRAM - the full grid is only built for the rules below
+        mario_position = self.perception.mario_position()
+        print(str(mario_position))
         if(mario_position == [0,0]):
             return 0
 
-        time.sleep(0.05)
+        self.wait(0.05)
 
-        if(self.check_position_object(game_area,mario_position,[[0,-1],[0,-1]],0) and (self.check_position_object(game_area,mario_position,[[1,-1],[1,-1]],0))):
+        if(self.perception.is_airborne(mario_position)):
             self.air_timeout = self.air_timeout + 1
             # if (game_area[14][11] == 0) or (game_area[14][12] == 0):
-            if (self.if_colume_void(game_area,mario_position,3) or self.if_colume_void(game_area,mario_position,4)):
-                print("void miss")
+            if (self.perception.column_void(mario_position,3) or self.perception.column_void(mario_position,4)):
+                self.rule("void miss")
                 return 1
-            elif(self.air_timeout < 6):
-                print("in air, wait")
+            elif(self.air_timeout < self.air_timeout_limit):
+                self.rule("in air, wait")
                 return 0
             else:
                 self.air_timeout = 0
-                print("in air, time out")
+                self.rule("in air, time out")
                 return 2
         elif(mario_position == [8,1]):
-            print("1-1 final go")
+            self.rule("1-1 final go")
             return 2
-        elif(self.check_position_object(game_area,mario_position,[[2,0],[2,1]],15)):
-            if(self.check_position_object(game_area,mario_position,[[0,3],[1,3]],12) or self.check_position_object(game_area,mario_position,[[0,3],[1,3]],13) or self.check_position_object(game_area,mario_position,[[0,3],[1,3]],10)):
-                print("15 frount blocked back")
-                self.action_queue = [1,1]
+
+        game_area = self.perception.game_area()
+        if self.debug:
+            print("===============================================")
+            print(game_area)
+            print("===============================================")
+        self.rules.evaluate(game_area, mario_position)
+        rules = self.rules
+
+        if(rules.hit("enemy_15_front")):
+            if(rules.hit("block_12_above") or rules.hit("block_13_above") or rules.hit("block_10_above")):
+                self.rule("15 frount blocked back")
+                self.action_queue.load(self.action_macros["enemy_15_blocked"])
                 return 1 #back
             else:
-                print("15 frount weit jump")
-                self.action_queue = [0,4]
+                self.rule("15 frount weit jump")
+                self.action_queue.load(self.action_macros["enemy_15_wait_jump"])
                 return 0
-        elif(self.check_position_object(game_area,mario_position,[[2,2],[2,3],[3,2],[3,3]],15)):
-            print("15 up close, back")
+        elif(rules.hit("enemy_15_up_close")):
+            self.rule("15 up close, back")
             return 1 #back
-        elif(self.check_position_object(game_area,mario_position,[[5,0],[5,0]],15)):
-            if(self.check_position_object(game_area,mario_position,[[0,3],[1,3]],12) or self.check_position_object(game_area,mario_position,[[0,3],[1,3]],13) or self.check_position_object(game_area,mario_position,[[0,3],[1,3]],10)):
-                print("15 frount blocked back")
+        elif(rules.hit("enemy_15_far")):
+            if(rules.hit("block_12_above") or rules.hit("block_13_above") or rules.hit("block_10_above")):
+                self.rule("15 frount blocked back")
                 return 1 #jump
             else:
-                print("15 frount jump")
+                self.rule("15 frount jump")
                 return 4 #jump
-        elif(self.check_position_object(game_area,mario_position,[[5,0],[5,0]],16)):
-            print("16 frount jump")
+        elif(rules.hit("enemy_16_far")):
+            self.rule("16 frount jump")
             return 4 #jump
-        elif(self.check_position_object(game_area,mario_position,[[2,0],[2,1],[3,0],[3,1]],18)):
-            print("18 frount jump")
+        elif(rules.hit("enemy_18_front")):
+            self.rule("18 frount jump")
             return 4 #jump
-        elif(self.check_position_object(game_area,mario_position,[[3,2],[3,3]],18)):
-            print("18 frount up back")
-            self.action_queue = [1,1,2]
+        elif(rules.hit("enemy_18_above")):
+            self.rule("18 frount up back")
+            self.action_queue.load(self.action_macros["enemy_18_above_back"])
             return 1 #back
-        elif(self.check_position_object(game_area,mario_position,[[2,-1],[2,-2],[3,-1],[3,-2]],15)):
-            print("15 down wati")
+        elif(rules.hit("enemy_15_below")):
+            self.rule("15 down wati")
             return 0 #jump
-        elif (self.check_position_object(game_area,mario_position,[[3,0],[3,1],[4,0],[4,1],[4,2],[4,3],[4,4],[5,3],[5,4],[6,3],[6,4]],15)):
-            print("15 up wait")
+        elif (rules.hit("enemy_15_ahead")):
+            self.rule("15 up wait")
             return 0 #wait
-        elif(self.check_position_object_AllMatch(game_area,mario_position,[[3,-1],[4,-1],[5,-1]],0) and self.check_position_object_AllMatch(game_area,mario_position,[[6,0],[6,1]], 10)):
+        elif(rules.hit("gap_3_to_5") and rules.hit("ledge_6")):
             self.handle_void_jump(game_area,mario_position,2)
             return 0
-        elif(self.check_position_object_AllMatch(game_area,mario_position,[[6,-1],[4,-1],[5,-1]],0) and self.check_position_object_AllMatch(game_area,mario_position,[[7,0],[7,1]], 10)):
+        elif(rules.hit("gap_4_to_6") and rules.hit("ledge_7")):
             self.handle_void_jump(game_area,mario_position,2)
             return 0
-        elif(self.check_position_object(game_area,mario_position,[[1,-1],[2,-1],[3,-1]],0) and (mario_position[1] == 13)):
+        elif(rules.hit("gap_1_to_3") and (mario_position[1] == 13)):
             self.handle_void_jump(game_area,mario_position,1)
             return 0
-        elif(self.check_position_object_AllMatch(game_area,mario_position,[[0,-1],[0,-2],[0,-3],[0,-4]],10) and self.check_position_object_AllMatch(game_area,mario_position,[[2,-1],[2,-2],[2,-3],[2,-4]],0) and (self.skip_count == 0)):
-            print("high void jump")
+        elif(rules.hit("column_under") and rules.hit("drop_ahead")):
+            self.rule("high void jump")
             return 4
-        elif (self.check_position_object(game_area,mario_position,[[0,4],[1,4]],13)):
-            print("13 top stop jump")
-            self.action_queue = [1,0,4]
+        elif (rules.hit("block_13_top")):
+            self.rule("13 top stop jump")
+            self.action_queue.load(self.action_macros["block_13_above_jump"])
             return 4 #jump
-        elif (self.check_position_object(game_area,mario_position,[[0,5],[0,6],[1,5],[1,6]],6)):
-            print("wait 6")
+        elif (rules.hit("tile_6_above")):
+            self.rule("wait 6")
             return 0 #wati
-        elif (self.check_position_object(game_area,mario_position,[[3,0],[2,0]],14)):
-            print("14 frount go jump")
-            self.action_queue = [2,2,4,2,2]
+        elif (rules.hit("pipe_14_front")):
+            self.rule("14 frount go jump")
+            self.action_queue.load(self.action_macros["pipe_14_jump"])
             return 4 #jump
-        elif (self.check_position_object(game_area,mario_position,[[3,0],[2,0],[1,0]],10)):
-            print("10 frount jump")
-            self.action_queue = [2,4,2,2] #bug
+        elif (rules.hit("block_10_front")):
+            self.rule("10 frount jump")
+            self.action_queue.load(self.action_macros["block_10_jump"]) #bug
             return 4 #jump
-        elif (self.check_position_object(game_area,mario_position,[[3,0],[2,0],[1,0],[3,1],[2,1],[1,1]],12)):
-            print("12 frount jump")
-            self.action_queue = [2,4,2,2] #bug
+        elif (rules.hit("block_12_front")):
+            self.rule("12 frount jump")
+            self.action_queue.load(self.action_macros["block_12_jump"]) #bug
             return 4 #jump
-        elif (state['stage'] == 2):
-            actions = self.one_two_optimise(game_area,mario_position)
-            if (len(actions) != 1):
-                self.action_queue = actions
+        elif (self.environment.get_stage() == 2):
+            # 1-2: hop over gaps and the raised blocks, otherwise keep running
+            if (rules.hit("gap_3") or rules.hit("block_10_high")):
+                self.rule("1-2 gap jump")
+                self.action_queue.load(self.action_macros["one_two_jump"])
                 return 0
             else:
-                return actions[0]
+                self.rule("1-2 go")
+                return 2
         else:
-            print("empty go")
+            self.rule("empty go")
             return 2 #frount
 
         # Implement your code here to choose the best action
@@ -231,112 +1087,125 @@ class MarioExpert:
 
         This is just a very basic example
         """
+        if self.profiler is not None:
+            if self.step_count == self.profile_window[0]:
+                self.profiler.start()
+            elif self.step_count == self.profile_window[1]:
+                self.stop_profiler()
+        self.step_count += 1
+
+        start = time.perf_counter()
 
         # Choose an action - button press or other...
 
         action = self.choose_action()
+        self.metrics.count("decisions")
+        self.metrics.record("choose_action", start)
         
-        if (self.action_queue != []):
-            action = self.action_queue[self.action_queue_index]
+        if (self.action_queue):
+            action = self.action_queue.pop()
             print("in queue, now doing: " + str(action))
-            if (self.action_queue_index == (len(self.action_queue) - 1)):
-                self.action_queue = []
-                self.action_queue_index = 0
-            else:
-                self.action_queue_index = self.action_queue_index + 1
 
         # Run the action on the environment
         self.environment.run_action(action)
+        self.metrics.record("step", start)
+
+    def rule(self, label):
+        # every rule announces itself - counted per label when metrics are enabled
+        print(label)
+        if self.metrics.enabled:
+            self.metrics.count(f"rule:{label}")
+
+    def metrics_summary(self):
+        summary = self.metrics.snapshot()
+        summary["perception"] = self.perception.report()
+        return summary
+
+    def finish_run(self):
+        # called once play() has written results.json - only rewritten when MARIO_METRICS=1 asked for the summary
+        self.stop_profiler()
+        if self.metrics.enabled:
+            with open(f"{self.results_path}/results.json", "r", encoding="utf-8") as file:
+                results = json.load(file)
+            results["metrics"] = self.metrics_summary()
+            with open(f"{self.results_path}/results.json", "w", encoding="utf-8") as file:
+                json.dump(results, file)
+        if self.metrics_server is not None:
+            stop_metrics(self.metrics_server)
+            self.metrics_server = None
+
+    def stop_profiler(self):
+        if self.profiler is not None and self.profiler.running:
+            self.profiler.stop()
+            self.profiler.dump(self.profile_path)
+            logging.info(f"Profile written to {self.profile_path}")
+
+    def wait(self, seconds):
+        # pacing for the windowed run - headless tools set delay_scale to 0
+        if self.delay_scale > 0:
+            start = time.perf_counter()
+            time.sleep(seconds * self.delay_scale)
+            self.metrics.count("sleeps")
+            self.metrics.record("sleep", start)
 
     def handle_void_jump(self,game_area,mario_position,void_type):
         if(void_type == 1):
-            print("void, jump")
+            self.rule("void, jump")
             self.environment.run_action(1)
-            time.sleep(0.1)
+            self.wait(0.1)
             self.environment.run_action(0)
-            time.sleep(0.1)
+            self.wait(0.1)
             self.environment.run_action(2)
-            time.sleep(0.1)
+            self.wait(0.1)
             self.environment.run_action(2)
-            time.sleep(0.1)
+            self.wait(0.1)
             self.environment.run_action(4)
-            time.sleep(0.1)
+            self.wait(0.1)
             self.environment.run_action(2)
-            time.sleep(0.1)
+            self.wait(0.1)
             self.environment.run_action(2)
-            time.sleep(0.1)
+            self.wait(0.1)
             self.environment.run_action(2)
         elif(void_type == 2):
-            print("big void, jump")
-            while (self.check_position_object(game_area,mario_position,[[1,-1],[2,-1],[3,-1],[4,-1],[5,-1],[6,-1]],0)):
-                print(game_area)
+            self.rule("big void, jump")
+            attempts = 0
+            while (self.rules.hit("gap_1_to_6") and self.void_jump_continues(attempts)):
+                attempts += 1
+                if self.debug:
+                    print(game_area)
                 self.environment.run_action(1)
-                time.sleep(0.1)
+                self.wait(0.1)
                 game_area = self.environment.game_area()
                 mario_position = self.get_mario_position(game_area)
-            while (self.check_position_object(game_area,mario_position,[[2,-1],[2,-1]],10)):
+                self.rules.evaluate(game_area, mario_position)
+            attempts = 0
+            while (self.rules.hit("ledge_2") and self.void_jump_continues(attempts)):
+                attempts += 1
                 self.environment.run_action(2)
-                time.sleep(0.1)
+                self.wait(0.1)
                 game_area = self.environment.game_area()
                 mario_position = self.get_mario_position(game_area)
+                self.rules.evaluate(game_area, mario_position)
             self.environment.run_action(3)
-            time.sleep(0.1)
+            self.wait(0.1)
             self.environment.run_action(4)
-            time.sleep(0.1)
+            self.wait(0.1)
             game_area = self.environment.game_area()
             mario_position = self.get_mario_position(game_area)
-            while (self.check_position_object(game_area,mario_position,[[0,-1],[0,-1]],10) == 0):
+            self.rules.evaluate(game_area, mario_position)
+            attempts = 0
+            while (not self.rules.hit("ground") and self.void_jump_continues(attempts)):
+                attempts += 1
                 self.environment.run_action(2)
-                time.sleep(0.1)
+                self.wait(0.1)
                 game_area = self.environment.game_area()
                 mario_position = self.get_mario_position(game_area)
+                self.rules.evaluate(game_area, mario_position)
 
-    def one_two_optimise(self,game_area,mario_position):
-        if (self.check_position_object(game_area,mario_position,[[3,-1],[3,-1]],0)):
-            return [2,4]
-        elif (self.check_position_object(game_area,mario_position,[[3,2],[3,3]],10)):
-            return [2,4]
-        else:
-            return [2]
-        
-    def if_colume_void(self,game_area,mario_position,colume):
-        for ii in range(mario_position[1],15):
-            if (game_area[(ii+1)][(colume+mario_position[0])] != 0):
-                return False
-        
-        return True
+    def void_jump_continues(self, attempts):
+        # the void jump loops run their own actions - stop them on game over or if Mario is stuck
+        return attempts < self.void_jump_limit and not self.environment.get_game_over()
 
-    def check_position_object(self, Game_Area,mario_position, target_positions, target_object):
-        #this function will return true if target object appears on ANY of the input positions
-        #target position using mario's local coordinate！！！！
-        #        +Y
-        #         ^   (local coodinate)
-        #         |
-        #       mario ---------> +x
-
-        print("search " + str(target_object) + " ", end="")
-        self.skip_count = 0
-
-        for Tpos_id in range(0,len(target_positions)):
-            target_position_global = [mario_position[1]-target_positions[Tpos_id][1],mario_position[0]+target_positions[Tpos_id][0]]
-            print(" " + str(target_position_global), end="")
-            if (target_position_global[0] < 0 or target_position_global[0] > 15 or target_position_global[1] < 0 or target_position_global[1] > 19):
-                print("skip")
-                self.skip_count = self.skip_count + 1
-            elif (Game_Area[target_position_global[0]][target_position_global[1]] == target_object):
-                print("")
-                return True
-        print("")
-        return False
-    
-    def check_position_object_AllMatch(self, Game_Area,mario_position, target_positions, target_object):
-        #this function will return true when all the target position is the target object
-        for Tpos_ID in range(0,len(target_positions)):
-            if(self.check_position_object(Game_Area,mario_position,[target_positions[Tpos_ID],target_positions[Tpos_ID]],target_object) == 0):
-                return False
-        
-        return True
-    
     def get_mario_position(self, Game_Area):
         # this function returns the position of mario   1  1
         objects_position = []  #  return position  ->  (1) 1
@@ -382,9 +1251,24 @@ class MarioExpert:
         """
         Do NOT edit this method.
         """
-        self.video = cv2.VideoWriter(
-            video_name, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height)
-        )
+        if self.segmented_video:
+            # width and height are the raw screen here - the segments are scaled to the usual 300x240
+            self.video = SegmentedRecorder(
+                video_name,
+                fps,
+                self.video_format,
+                self.video_segment,
+                stride=self.video_stride,
+                workers=self.video_workers,
+                metrics=self.metrics,
+            )
+        else:
+            self.video = cv2.VideoWriter(
+                video_name, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height)
+            )
+
+        # play() only ever calls write and release - see EpisodeRecorder
+        self.video = EpisodeRecorder(self.video, self)
 
     def stop_video(self) -> None:
         """
@@ -0,0 +1,239 @@
+"""
+Parameter sweep for the Mario Expert agent.
+
+Evaluates grid or random samples of the agent's tunables (act_freq, the air timeout limit and the queued
+action macros) headlessly across a process pool. Clearly losing configurations are cut early through
+successive halving on x-progress, and the survivors are ranked the same way as compare_results.py.
+
+Budgets are counted in emulator frames rather than agent steps so configurations with a larger act_freq do not get
+more game time for the same budget.
+
+Examples:
+    python3 sweep.py --mode random --samples 32 --workers 8
+    python3 sweep.py --mode grid --vary act_freq,air_timeout_limit
+    python3 sweep.py --mode grid --param act_freq=8,10,12 --param pipe_14_jump=2:2:4:2:2,4:2:2
+"""
+
+import argparse
+import contextlib
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from functools import cmp_to_key
+
+from compare_results import compare_performance
+
+logging.basicConfig(level=logging.INFO)
+
+# Values each tunable can take - macros are listed as alternative action sequences
+PARAMETER_SPACE = {
+    "act_freq": [6, 8, 10, 12, 14],
+    "air_timeout_limit": [4, 5, 6, 7, 8],
+    "enemy_15_blocked": [[1, 1], [1], [1, 1, 1]],
+    "enemy_15_wait_jump": [[0, 4], [4], [0, 0, 4]],
+    "enemy_18_above_back": [[1, 1, 2], [1, 2], [1, 1]],
+    "block_13_above_jump": [[1, 0, 4], [0, 4], [1, 4]],
+    "pipe_14_jump": [[2, 2, 4, 2, 2], [2, 4, 2, 2], [4, 2, 2]],
+    "block_10_jump": [[2, 4, 2, 2], [4, 2, 2], [2, 4, 2]],
+    "block_12_jump": [[2, 4, 2, 2], [4, 2, 2], [2, 4, 2]],
+}
+
+
+def grid_samples(space):
+    names = list(space.keys())
+    for values in itertools.product(*(space[name] for name in names)):
+        yield dict(zip(names, values))
+
+
+def random_samples(space, samples, seed):
+    rng = random.Random(seed)
+    return [
+        {name: rng.choice(values) for name, values in space.items()}
+        for _ in range(samples)
+    ]
+
+
+def parse_space(vary, params):
+    """
+    Narrows PARAMETER_SPACE to the names in vary (all of them if empty) and overrides or adds the value lists given
+    as name=value,value - macro actions are separated by ":". Tunables left out keep the agent's defaults.
+    """
+    unknown = [name for name in vary if name not in PARAMETER_SPACE]
+    if unknown:
+        raise ValueError(f"Unknown parameters in --vary: {unknown}")
+
+    space = {name: values for name, values in PARAMETER_SPACE.items() if not vary or name in vary}
+
+    for param in params:
+        name, _, values = param.partition("=")
+        if name not in PARAMETER_SPACE:
+            raise ValueError(f"Unknown parameter in --param: {name}")
+        if isinstance(PARAMETER_SPACE[name][0], list):
+            space[name] = [[int(action) for action in value.split(":")] for value in values.split(",")]
+        else:
+            space[name] = [int(value) for value in values.split(",")]
+
+    return space
+
+
+def evaluate(params, max_frames):
+    """
+    Runs one configuration from the initial state for at most max_frames emulator frames and returns its final game
+    state.
+    """
+    # Imported here so the pool workers each create their own emulator
+    from mario_expert import MarioExpert
+
+    with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+        expert = MarioExpert(results_path="", headless=True)
+        expert.delay_scale = 0.0
+
+        for name, value in params.items():
+            if name == "act_freq":
+                expert.environment.act_freq = value
+            elif name in expert.action_macros:
+                expert.action_macros[name] = list(value)
+            else:
+                setattr(expert, name, value)
+
+        expert.environment.reset()
+
+        pyboy = expert.environment.pyboy
+        start_frame = pyboy.frame_count
+        steps = 0
+        try:
+            while pyboy.frame_count - start_frame < max_frames and not expert.environment.get_game_over():
+                expert.step()
+                steps += 1
+            result = expert.environment.game_state()
+        except Exception:
+            # one broken configuration must not take the rest of the sweep down with it
+            result = {"world": 0, "stage": 0, "score": 0, "x_position": 0, "error": traceback.format_exc()}
+        finally:
+            expert.environment.pyboy.stop(save=False)
+
+    result["steps"] = steps
+    result["frames"] = pyboy.frame_count - start_frame
+    return result
+
+
+def progress(result):
+    # x_position restarts every stage so it only breaks ties within the same world and stage
+    return (result["world"], result["stage"], result["x_position"])
+
+
+def successive_halving(configs, workers, min_frames, max_frames, eta):
+    """
+    Evaluates every configuration for min_frames, keeps the best 1/eta by x-progress and repeats with eta times
+    the budget until one configuration is left or max_frames is reached.
+    """
+    results = [None] * len(configs)
+    survivors = list(range(len(configs)))
+    budget = min_frames
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while True:
+            logging.info(f"Evaluating {len(survivors)} configurations for {budget} frames")
+
+            round_results = pool.map(
+                evaluate,
+                [configs[i] for i in survivors],
+                itertools.repeat(budget),
+            )
+            for i, result in zip(survivors, round_results):
+                result["budget"] = budget
+                results[i] = result
+
+            if len(survivors) == 1 or budget >= max_frames:
+                break
+
+            survivors = [i for i in survivors if "error" not in results[i]]
+            if not survivors:
+                break
+            survivors = sorted(survivors, key=lambda i: progress(results[i]), reverse=True)
+            survivors = survivors[: max(1, math.ceil(len(survivors) / eta))]
+            budget = min(budget * eta, max_frames)
+
+    return results
+
+
+def compare_sweep(result_one, result_two):
+    # Configurations that crashed rank last
+    if ("error" in result_one) != ("error" in result_two):
+        return 1 if "error" in result_one else -1
+
+    # Configurations cut in an earlier round always rank below those that ran longer
+    if result_one["budget"] != result_two["budget"]:
+        return -1 if result_one["budget"] > result_two["budget"] else 1
+
+    return compare_performance(result_one, result_two)
+
+
+def get_args():
+    parse_args = argparse.ArgumentParser()
+
+    parse_args.add_argument("--mode", type=str, choices=["grid", "random"], default="random")
+    parse_args.add_argument("--samples", type=int, default=32)
+    parse_args.add_argument("--max_grid", type=int, default=500)
+    parse_args.add_argument("--vary", type=str, default="")
+    parse_args.add_argument("--param", type=str, action="append", default=[])
+    parse_args.add_argument("--seed", type=int, default=0)
+    parse_args.add_argument("--workers", type=int, default=os.cpu_count())
+    parse_args.add_argument("--min_frames", type=int, default=1000)
+    parse_args.add_argument("--max_frames", type=int, default=30000)
+    parse_args.add_argument("--eta", type=int, default=3)
+    parse_args.add_argument("-o", "--output", type=str, default=None)
+
+    return parse_args.parse_args()
+
+
+def main():
+    args = get_args()
+
+    vary = [name for name in args.vary.split(",") if name]
+    space = parse_space(vary, args.param)
+
+    if args.mode == "grid":
+        # --samples does not apply - every combination boots its own emulator so refuse huge grids
+        grid_size = math.prod(len(values) for values in space.values())
+        logging.info(f"Grid has {grid_size} configurations")
+        if grid_size > args.max_grid:
+            raise ValueError(
+                f"Grid of {grid_size} configurations exceeds --max_grid {args.max_grid} - "
+                "narrow it with --vary/--param, raise --max_grid or use --mode random"
+            )
+        configs = list(grid_samples(space))
+    else:
+        configs = random_samples(space, args.samples, args.seed)
+
+    logging.info(f"Sweeping {len(configs)} configurations with {args.workers} workers")
+
+    results = successive_halving(
+        configs, args.workers, args.min_frames, args.max_frames, args.eta
+    )
+
+    ranked = []
+    for config, result in zip(configs, results):
+        ranked.append({**result, "params": config})
+    ranked = sorted(ranked, key=cmp_to_key(compare_sweep))
+
+    for i, result in enumerate(ranked):
+        logging.info(
+            f"Rank {i + 1}: World: {result['world']} Stage: {result['stage']} Score: {result['score']} "
+            f"X: {result['x_position']} Frames: {result['frames']} - {result['params']}"
+        )
+        if "error" in result:
+            logging.warning(f"Rank {i + 1} failed:\n{result['error']}")
+
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(ranked, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
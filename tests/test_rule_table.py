@@ -0,0 +1,97 @@
+import random
+import sys
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+pytest.importorskip("cv2")
+pytest.importorskip("pyboy")
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "scripts"))
+
+from mario_expert import RULES, ActionQueue, RuleTable  # noqa: E402
+
+
+def reference_hit(game_area, mario_position, check):
+    # the per-offset scan the rule table replaced
+    matches = []
+    for dx, dy in check["offsets"]:
+        row = mario_position[1] - dy
+        col = mario_position[0] + dx
+        matches.append(0 <= row <= 15 and 0 <= col <= 19 and game_area[row][col] == check["tile"])
+    return any(matches) if check["match"] == "any" else all(matches)
+
+
+def test_rule_table_matches_reference():
+    rules = RuleTable(RULES)
+    rng = random.Random(0)
+    tiles = [0, 0, 0, 1, 6, 10, 12, 13, 14, 15, 16, 18]
+
+    for _ in range(500):
+        game_area = np.array(
+            [[rng.choice(tiles) for _ in range(20)] for _ in range(16)], dtype=np.uint32
+        )
+        mario_position = [rng.randint(-2, 21), rng.randint(-2, 17)]
+
+        rules.evaluate(game_area, mario_position)
+
+        for name, check in RULES["checks"].items():
+            assert bool(rules.hit(name)) == reference_hit(game_area, mario_position, check), name
+
+
+def test_action_queue_keeps_read_position_across_loads():
+    queue = ActionQueue()
+
+    queue.load((2, 2, 4, 2, 2))
+    assert [queue.pop(), queue.pop()] == [2, 2]
+
+    queue.load((1, 0, 4))
+    assert queue.pop() == 4
+    assert len(queue) == 0
+
+    queue.load((0, 4))
+    queue.pop()
+    queue.load((1,))
+    with pytest.raises(IndexError):
+        queue.pop()
+
+
+def decide(rules, queue, game_area, mario_position):
+    # the rule and queue half of choose_action - no loops, their iterators would be the test's own allocations
+    rules.evaluate(game_area, mario_position)
+    if rules.hit("enemy_15_front") or rules.hit("pipe_14_front"):
+        pass
+    if not queue:
+        queue.load(rules.macros["pipe_14_jump"])
+    return queue.pop()
+
+
+def test_rules_and_queue_do_not_allocate():
+    rules = RuleTable(RULES)
+    queue = ActionQueue()
+    game_area = np.zeros((16, 20), dtype=np.uint32)
+    game_area[12:, :] = 10
+    mario_position = [5, 10]
+
+    tracemalloc.start()
+    try:
+        # warm up under tracing - the grid buffers and NumPy's own caches are allocated on the first calls
+        for _ in range(10):
+            decide(rules, queue, game_area, mario_position)
+
+        before = tracemalloc.get_traced_memory()[0]
+        transient = 0
+        for _ in range(1000):
+            tracemalloc.reset_peak()
+            decide(rules, queue, game_area, mario_position)
+            current, peak = tracemalloc.get_traced_memory()
+            transient = max(transient, peak - current)
+        growth = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+    # the peak catches anything allocated and freed within a decision, the growth anything kept across them
+    assert transient == 0
+    assert growth < 1024